@@ -1,11 +1,18 @@
 import dash
 import dash_bootstrap_components as dbc
-from dash import Input, Output, dcc, html, callback, State
+import diskcache
+from dash import Input, Output, dcc, html, callback, State, DiskcacheManager
 from utils.ansaetze import Ansaetze
 from typing import Any, Dict, Optional
 
+# background callbacks (e.g. the training) run in separate processes
+# so that they do not block the other callbacks
+background_callback_manager = DiskcacheManager(diskcache.Cache(".cache/callbacks"))
+
 app = dash.Dash(
-    external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME], use_pages=True
+    external_stylesheets=[dbc.themes.BOOTSTRAP, dbc.icons.FONT_AWESOME],
+    use_pages=True,
+    background_callback_manager=background_callback_manager,
 )
 app.title = "Favicon"
 sidebar = html.Div(
@@ -9,7 +9,7 @@ from pennylane.fourier import coefficients
 from pennylane.fourier.visualize import _extract_data_and_labels
 from functools import partial
 
-from utils.instructor import Instructor
+from utils.instructor import Instructor, round_probs
 
 dash.register_page(__name__, name="Noise Viz")
 
@@ -152,6 +152,8 @@ def update_page_data(_, page_data):
 )
 def on_preference_changed(bf, pf, ad, pd, dp):
 
+    bf, pf, ad, pd, dp = round_probs(bf, pf, ad, pd, dp)
+
     # Give a default data dict with 0 clicks if there's no data.
     data = dict(bf=bf, pf=pf, ad=ad, pd=pd, dp=dp)
 
@@ -1,3 +1,6 @@
+import base64
+from typing import Dict, NamedTuple, Tuple
+
 import dash
 import numpy as np
 from dash import (
@@ -7,23 +10,86 @@ from dash import (
     Input,
     State,
     Output,
+    Patch,
     callback,
 )
 import plotly.graph_objects as go
 from dash.exceptions import PreventUpdate
 
 
-from utils.instructor import Instructor
+from utils.instructor import get_instructor, round_probs
 from utils.entangling import EntanglingCapability_Sampler
 
 import dash_bootstrap_components as dbc
 
 dash.register_page(__name__, name="Noise Training")
 
+
+def _encode(arr: np.ndarray) -> str:
+    """Encodes an array as base64 float32 bytes for the session storage."""
+    return base64.b64encode(np.asarray(arr, dtype=np.float32).tobytes()).decode()
+
+
+def _decode(s: str, shape: Tuple[int, ...] = (-1,)) -> np.ndarray:
+    """Decodes an array that was encoded with _encode."""
+    arr = np.frombuffer(base64.b64decode(s), dtype=np.float32)
+    return arr.reshape(shape) if arr.size > 0 else arr
+
+
+class _Settings(NamedTuple):
+    """Noise probabilities and model settings read from the session storage."""
+
+    bf: float
+    pf: float
+    ad: float
+    pd: float
+    dp: float
+    n_qubits: int
+    n_layers: int
+    seed: int
+    circuit_type: str
+    data_reupload: bool
+
+    @property
+    def noise(self) -> Dict[str, float]:
+        return dict(bf=self.bf, pf=self.pf, ad=self.ad, pd=self.pd, dp=self.dp)
+
+
+def _unpack(page_data: dict, main_data: dict) -> _Settings:
+    """Reads the settings from the page and main storage."""
+    bf, pf, ad, pd, dp = round_probs(
+        page_data["bf"],
+        page_data["pf"],
+        page_data["ad"],
+        page_data["pd"],
+        page_data["dp"],
+    )
+    return _Settings(
+        bf=bf,
+        pf=pf,
+        ad=ad,
+        pd=pd,
+        dp=dp,
+        n_qubits=main_data["number_qubits"],
+        n_layers=main_data["number_layers"],
+        seed=main_data["seed"],
+        circuit_type=main_data["circuit_type"],
+        data_reupload=main_data["data_reupload"],
+    )
+
+
 layout = html.Div(
     [
         dcc.Store(id="storage-noise-training-viz", storage_type="session"),
-        dcc.Store(id="storage-noise-training-proc", storage_type="session"),
+        # latest weights and history of the loss and entangling capability
+        dcc.Store(id="storage-noise-training-weights", storage_type="session"),
+        dcc.Store(id="storage-noise-training-loss", storage_type="session"),
+        dcc.Store(id="storage-noise-training-ent", storage_type="session"),
+        # number of completed training steps, which is only updated by the
+        # training itself and triggers the figure updates
+        dcc.Store(id="storage-noise-training-step", storage_type="session"),
+        # number of the training step to run next
+        dcc.Store(id="storage-noise-training-next", storage_type="session"),
         dcc.Store(id="storage-noise-hist-proc", storage_type="session"),
         dcc.Interval(
             id="interval-component",
@@ -263,7 +329,7 @@ def on_preference_changed(bf, pf, ad, pd, dp, steps):
 
     # Give a default data dict with 0 clicks if there's no data.
     page_data = dict(bf=bf, pf=pf, ad=ad, pd=pd, dp=dp, steps=steps)
-    page_log_hist = {"x": [], "y": [], "z": []}
+    page_log_hist = {"x": [], "y": [], "z": ""}
 
     return page_data, page_log_hist
 
@@ -271,126 +337,98 @@ def on_preference_changed(bf, pf, ad, pd, dp, steps):
 @callback(
     [
         Output("fig-training-hist", "figure"),
+        Output("fig-training-expval", "figure"),
+        Output("fig-training-metric", "figure"),
         Output("storage-noise-hist-proc", "data", allow_duplicate=True),
     ],
-    Input("storage-noise-training-proc", "modified_timestamp"),
+    Input("storage-noise-training-step", "data"),
     [
-        State("storage-noise-training-proc", "data"),
+        State("storage-noise-training-weights", "data"),
+        State("storage-noise-training-loss", "data"),
         State("storage-noise-hist-proc", "data"),
         State("storage-noise-training-viz", "data"),
         State("storage-main", "data"),
     ],
     prevent_initial_call=True,
 )
-def update_hist(n, page_log_training, page_log_hist, page_data, main_data):
+def update_figures(n, weights, loss, page_log_hist, page_data, main_data):
+    # all figures are updated in a single callback,
+    # so that the state is only read and prepared once per step
     fig_hist = go.Figure()
+    fig_expval = go.Figure()
+    fig_loss = go.Figure()
 
-    if page_log_training is not None and len(page_log_training["loss"]) > 0:
-        instructor = Instructor(
-            main_data["number_qubits"],
-            main_data["number_layers"],
-            seed=main_data["seed"],
-            circuit_type=main_data["circuit_type"],
-            data_reupload=main_data["data_reupload"],
-        )
+    if loss is not None and len(loss) > 0:
+        settings = _unpack(page_data, main_data)
 
-        bf, pf, ad, pd, dp = (
-            page_data["bf"],
-            page_data["pf"],
-            page_data["ad"],
-            page_data["pd"],
-            page_data["dp"],
+        instructor = get_instructor(
+            settings.n_qubits,
+            settings.n_layers,
+            seed=settings.seed,
+            circuit_type=settings.circuit_type,
+            data_reupload=settings.data_reupload,
         )
+        weights = _decode(weights, instructor.model.n_params)
 
         data_len, data = instructor.calc_hist(
-            page_log_training["weights"],
-            bf=bf,
-            pf=pf,
-            ad=ad,
-            pd=pd,
-            dp=dp,
+            weights,
+            **settings.noise,
         )
 
+        z_hist = _decode(page_log_hist["z"])
         page_log_hist["x"] = np.arange(-data_len // 2 + 1, data_len // 2 + 1, 1)
-        page_log_hist["y"] = [i for i in range(len(page_log_training["loss"]))]
-        page_log_hist["z"].append(data["comb"][0].tolist())
-
-        fig_hist.add_surface(
-            x=np.array(page_log_hist["x"]),
-            y=np.array(page_log_hist["y"]),
-            z=np.array(page_log_hist["z"]),
-            showscale=False,
-            showlegend=False,
-        )
-    else:
-        page_log_hist = {"x": [], "y": [], "z": []}
-
-    fig_hist.update_layout(
-        title="Histogram (Absolute Value)",
-        template="simple_white",
-        scene=dict(
-            xaxis=dict(
-                title="Frequency",
-            ),
-            yaxis=dict(title="Step"),
-            zaxis=dict(
-                title="Amplitude",
-            ),
-        ),
-        scene_camera=dict(
-            up=dict(x=0, y=0, z=1.2),
-            center=dict(x=0.1, y=0, z=-0.2),
-            eye=dict(x=0.95, y=1.85, z=0.75),
-        ),
-        coloraxis_showscale=False,
-    )
-
-    return fig_hist, page_log_hist
-
-
-@callback(
-    Output("fig-training-expval", "figure"),
-    Input("storage-noise-training-proc", "modified_timestamp"),
-    [
-        State("storage-noise-training-proc", "data"),
-        State("storage-noise-training-viz", "data"),
-        State("storage-main", "data"),
-    ],
-    prevent_initial_call=True,
-)
-def update_expval(n, page_log_training, page_data, main_data):
-    fig_expval = go.Figure()
-
-    if page_log_training is not None and len(page_log_training["loss"]) > 0:
-        instructor = Instructor(
-            main_data["number_qubits"],
-            main_data["number_layers"],
-            seed=main_data["seed"],
-            circuit_type=main_data["circuit_type"],
-            data_reupload=main_data["data_reupload"],
-        )
-
-        bf, pf, ad, pd, dp = (
-            page_data["bf"],
-            page_data["pf"],
-            page_data["ad"],
-            page_data["pd"],
-            page_data["dp"],
-        )
+        page_log_hist["y"] = [i for i in range(len(loss))]
+        page_log_hist["z"] = _encode(np.concatenate([z_hist, data["comb"][0]]))
+
+        # the surface is already shown, so only send the newest row
+        # instead of the whole history
+        if z_hist.size > 0:
+            fig_hist = Patch()
+            fig_hist["data"][0]["y"].append(page_log_hist["y"][-1])
+            fig_hist["data"][0]["z"].append(data["comb"][0].tolist())
+        else:
+            fig_hist.add_surface(
+                x=page_log_hist["x"].tolist(),
+                y=page_log_hist["y"][-1:],
+                z=[data["comb"][0].tolist()],
+                showscale=False,
+                showlegend=False,
+            )
 
         y_pred = instructor.forward(
             instructor.x_d,
-            weights=page_log_training["weights"],
-            bf=bf,
-            pf=pf,
-            ad=ad,
-            pd=pd,
-            dp=dp,
+            weights=weights,
+            **settings.noise,
         )
 
         fig_expval.add_scatter(x=instructor.x_d, y=y_pred, name="Prediction")
         fig_expval.add_scatter(x=instructor.x_d, y=instructor.y_d, name="Target")
 
+        fig_loss.add_scatter(y=loss)
+    else:
+        page_log_hist = {"x": [], "y": [], "z": ""}
+
+    if not isinstance(fig_hist, Patch):
+        fig_hist.update_layout(
+            title="Histogram (Absolute Value)",
+            template="simple_white",
+            scene=dict(
+                xaxis=dict(
+                    title="Frequency",
+                ),
+                yaxis=dict(title="Step"),
+                zaxis=dict(
+                    title="Amplitude",
+                ),
+            ),
+            scene_camera=dict(
+                up=dict(x=0, y=0, z=1.2),
+                center=dict(x=0.1, y=0, z=-0.2),
+                eye=dict(x=0.95, y=1.85, z=0.75),
+            ),
+            coloraxis_showscale=False,
+        )
+
     fig_expval.update_layout(
         title="Output",
         template="simple_white",
@@ -400,22 +438,31 @@ def update_expval(n, page_log_training, page_data, main_data):
         legend=dict(yanchor="top", y=0.99, xanchor="left", x=0.01),
     )
 
-    return fig_expval
+    fig_loss.update_layout(
+        title="Loss",
+        template="simple_white",
+        xaxis_title="Step",
+        yaxis_title="Loss",
+        xaxis_range=[0, page_data["steps"]],
+        autosize=False,
+    )
+
+    return fig_hist, fig_expval, fig_loss, page_log_hist
 
 
 @callback(
     Output("fig-training-ent", "figure"),
-    Input("storage-noise-training-proc", "modified_timestamp"),
+    Input("storage-noise-training-step", "data"),
     [
-        State("storage-noise-training-proc", "data"),
+        State("storage-noise-training-ent", "data"),
         State("storage-noise-training-viz", "data"),
     ],
     prevent_initial_call=True,
 )
-def update_ent_cap(n, page_log_training, data):
+def update_ent_cap(n, ent_cap, data):
     fig_ent_cap = go.Figure()
-    if page_log_training is not None and len(page_log_training["ent_cap"]) > 0:
-        fig_ent_cap.add_scatter(y=page_log_training["ent_cap"])
+    if ent_cap is not None and len(ent_cap) > 0:
+        fig_ent_cap.add_scatter(y=ent_cap)
 
     fig_ent_cap.update_layout(
         title="Entangling Capability",
@@ -430,133 +477,96 @@ def update_ent_cap(n, page_log_training, data):
 
 
 @callback(
-    Output("fig-training-metric", "figure"),
-    Input("storage-noise-training-proc", "modified_timestamp"),
     [
-        State("storage-noise-training-proc", "data"),
-        State("storage-noise-training-viz", "data"),
-    ],
-    prevent_initial_call=True,
-)
-def update_loss(n, page_log_training, data):
-    fig_expval = go.Figure()
-    if page_log_training is not None and len(page_log_training["loss"]) > 0:
-        fig_expval.add_scatter(y=page_log_training["loss"])
-
-    fig_expval.update_layout(
-        title="Loss",
-        template="simple_white",
-        xaxis_title="Step",
-        yaxis_title="Loss",
-        xaxis_range=[0, data["steps"]],
-        autosize=False,
-    )
-
-    return fig_expval
-
-
-@callback(
-    [
-        Output("storage-noise-training-proc", "data", allow_duplicate=True),
+        Output("storage-noise-training-weights", "data", allow_duplicate=True),
+        Output("storage-noise-training-loss", "data", allow_duplicate=True),
+        Output("storage-noise-training-ent", "data", allow_duplicate=True),
+        Output("storage-noise-training-step", "data", allow_duplicate=True),
         Output("training-button", "disabled", allow_duplicate=True),
     ],
     Input("training-button", "n_clicks"),
     prevent_initial_call=True,
 )
 def trigger_training(_):
-    page_log = {"loss": [], "weights": [], "ent_cap": []}
-
-    return [page_log, True]
+    return ["", [], [], 0, True]
 
 
 @callback(
-    Output("training-button", "disabled", allow_duplicate=True),
-    Input("storage-noise-training-proc", "modified_timestamp"),
     [
-        State("storage-noise-training-proc", "data"),
-        State("storage-noise-training-viz", "data"),
+        Output("storage-noise-training-next", "data"),
+        Output("training-button", "disabled", allow_duplicate=True),
     ],
-    prevent_initial_call=True,
-)
-def stop_training(_, page_log_training, page_data):
-    if (
-        page_log_training is not None
-        and len(page_log_training["loss"]) <= page_data["steps"]
-    ):
-        raise PreventUpdate()
-
-    return False
-
-
-@callback(
-    Output("storage-noise-training-proc", "data", allow_duplicate=True),
-    Input("storage-noise-training-proc", "modified_timestamp"),
+    # listening to the timestamp instead of the data avoids a circular
+    # dependency between this callback and the training
+    Input("storage-noise-training-step", "modified_timestamp"),
     [
-        State("storage-noise-training-proc", "data"),
+        State("storage-noise-training-step", "data"),
         State("storage-noise-training-viz", "data"),
     ],
     prevent_initial_call=True,
 )
-def pong(_, page_log_training, data):
-    if page_log_training is None or len(page_log_training["loss"]) > data["steps"]:
+def next_step(_, step, page_data):
+    if step is None:
         raise PreventUpdate()
-    return page_log_training
+
+    # request the next step until the training is done, i.e. only
+    # the step number is passed back and forth between the callbacks
+    if step <= page_data["steps"]:
+        return step + 1, dash.no_update
+
+    return dash.no_update, False
 
 
 @callback(
-    Output("storage-noise-training-proc", "data"),
     [
-        Input("storage-noise-training-proc", "data"),
+        Output("storage-noise-training-weights", "data"),
+        Output("storage-noise-training-loss", "data"),
+        Output("storage-noise-training-ent", "data"),
+        Output("storage-noise-training-step", "data"),
     ],
+    Input("storage-noise-training-next", "data"),
     [
+        State("storage-noise-training-weights", "data"),
+        State("storage-noise-training-loss", "data"),
+        State("storage-noise-training-ent", "data"),
         State("storage-noise-training-viz", "data"),
         State("storage-main", "data"),
     ],
     prevent_initial_call=True,
+    background=True,
+    # a step takes far less than the default polling interval of 1 s
+    interval=100,
 )
-def training(page_log_training, page_data, main_data):
-    if page_log_training is None:
-        raise PreventUpdate()
-
-    if len(page_log_training["loss"]) > page_data["steps"]:
-        page_log_training["loss"] = []
-        page_log_training["weights"] = []
-        page_log_training["ent_cap"] = []
-
-    bf, pf, ad, pd, dp = (
-        page_data["bf"],
-        page_data["pf"],
-        page_data["ad"],
-        page_data["pd"],
-        page_data["dp"],
-    )
-
-    instructor = Instructor(
-        main_data["number_qubits"],
-        main_data["number_layers"],
-        seed=main_data["seed"],
-        circuit_type=main_data["circuit_type"],
-        data_reupload=main_data["data_reupload"],
+def training(_, weights, loss, ent_cap, page_data, main_data):
+    settings = _unpack(page_data, main_data)
+
+    instructor = get_instructor(
+        settings.n_qubits,
+        settings.n_layers,
+        seed=settings.seed,
+        circuit_type=settings.circuit_type,
+        data_reupload=settings.data_reupload,
     )
 
-    page_log_training["weights"], cost = instructor.step(
-        page_log_training["weights"], bf=bf, pf=pf, ad=ad, pd=pd, dp=dp
+    weights, cost = instructor.step(
+        _decode(weights, instructor.model.n_params),
+        **settings.noise,
     )
-    page_log_training["loss"].append(cost.item())
+    loss.append(cost.item())
 
     ent_sampler = EntanglingCapability_Sampler(
-        main_data["number_qubits"],
-        main_data["number_layers"],
-        main_data["seed"],
-        main_data["circuit_type"],
-        main_data["data_reupload"],
+        settings.n_qubits,
+        settings.n_layers,
+        settings.seed,
+        settings.circuit_type,
+        settings.data_reupload,
     )
 
-    if main_data["number_qubits"] > 1:
-        ent_cap = ent_sampler.calculate_entangling_capability(
-            10, bf=bf, pf=pf, ad=ad, pd=pd, dp=dp, params=page_log_training["weights"]
+    if settings.n_qubits > 1:
+        ent_cap_step = ent_sampler.calculate_entangling_capability(
+            10, params=weights, **settings.noise
         )
 
-        page_log_training["ent_cap"].append(ent_cap)
+        ent_cap.append(ent_cap_step)
 
-    return page_log_training
+    return _encode(weights), loss, ent_cap, len(loss)
@@ -16,7 +16,7 @@ from pennylane.fourier import coefficients
 from functools import partial
 from pennylane.fourier.visualize import _extract_data_and_labels
 
-from utils.instructor import Instructor
+from utils.instructor import Instructor, round_probs
 from utils.expressibility import (
     Expressibility_Sampler,
     get_sampled_haar_probability_histogram,
@@ -304,6 +304,8 @@ def on_preference_changed(
     dp,
 ):
 
+    bf, pf, ad, pd, dp = round_probs(bf, pf, ad, pd, dp)
+
     # Give a default data dict with 0 clicks if there's no data.
     data = dict(
         n_samples=n_samples,
@@ -1,15 +1,40 @@
 from typing import Any, Dict, Optional, Tuple, List
 
 import pennylane as qml
-import pennylane.numpy as np
-from pennylane.fourier import coefficients
-from functools import partial
-from pennylane.fourier.visualize import _extract_data_and_labels
+import numpy as np
+import pennylane.numpy as pnp
+from functools import lru_cache
 import hashlib
 import os
+import threading
 
 from utils.ansaetze import Ansaetze
 
+_X_DOMAIN = [-1 * np.pi, 1 * np.pi]  # [-4 * np.pi, 4 * np.pi]
+_OMEGA_D = np.array([1, 2, 3])
+
+_N_D = int(np.ceil(2 * np.max(np.abs(_X_DOMAIN)) * np.max(_OMEGA_D)))
+_X_D = np.linspace(_X_DOMAIN[0], _X_DOMAIN[1], _N_D)
+
+# evaluate the target for all x at once by broadcasting against omega_d
+_Y_D = np.sum(np.cos(_X_D[:, None] * _OMEGA_D[None, :]), axis=1)
+_Y_D = _Y_D / np.linalg.norm(_OMEGA_D)
+
+
+def round_probs(*probs: float) -> Tuple[float, ...]:
+    """Round noise probabilities to the slider resolution.
+
+    The probabilities are used as keys of the Kraus and result caches,
+    where floating point drift (e.g. 0.30000000000000004) prevents hits.
+
+    Args:
+        *probs (float): The noise probabilities.
+
+    Returns:
+        Tuple[float, ...]: The rounded probabilities.
+    """
+    return tuple(round(p, 3) for p in probs)
+
 
 class Model:
     """
@@ -39,8 +64,15 @@ class Model:
         pqc (Callable[[np.ndarray], None]): A callable function that applies
             the quantum circuit to the provided parameters.
         n_params (int): The number of parameters in the circuit.
-        dev (qml.Device): The quantum device to use for the circuit.
-        circuit (qml.QNode): The quantum circuit as a QNode.
+        dev (qml.Device): The density matrix device to use for the circuit
+            if noise is applied.
+        dev_pure (qml.Device): The state vector device to use for the circuit
+            if no noise is applied.
+        circuit (qml.QNode): The quantum circuit as a QNode on dev.
+        circuit_pure (qml.QNode): The quantum circuit as a QNode on dev_pure.
+        circuit_lightning (Optional[qml.QNode]): The quantum circuit as a
+            QNode on lightning.qubit for single noise-free evaluations,
+            or None if lightning is not available.
 
     """
 
@@ -69,8 +101,33 @@ class Model:
         self.n_params = (impl_n_layers, self.pqc(None, self.n_qubits))
 
         self.dev = qml.device("default.mixed", wires=n_qubits)
+        # without noise, all channels are identities and simulating the
+        # density matrix is wasted work compared to the state vector
+        self.dev_pure = qml.device("default.qubit", wires=n_qubits)
+
+        # x may be passed as a 1D array, which is evaluated as a
+        # broadcasted batch within a single QNode call.
+        # backprop computes the gradient in a single pass instead of
+        # two circuit evaluations per parameter with the parameter shift rule
+        self.circuit = qml.QNode(
+            self._circuit, self.dev, interface="autograd", diff_method="backprop"
+        )
+        self.circuit_pure = qml.QNode(
+            self._circuit, self.dev_pure, interface="autograd", diff_method="backprop"
+        )
 
-        self.circuit = qml.QNode(self._circuit, self.dev)
+        # lightning.qubit is faster for single evaluations but does not
+        # support broadcasting, see __call__
+        try:
+            self.circuit_lightning = qml.QNode(
+                self._circuit,
+                qml.device("lightning.qubit", wires=n_qubits),
+                interface="autograd",
+                diff_method="adjoint",
+                grad_on_execution=False,
+            )
+        except qml.DeviceError:
+            self.circuit_lightning = None
 
     def iec(
         self,
@@ -131,12 +188,13 @@ class Model:
             if self.data_reupload or l == 0:
                 self.iec(x, data_reupload=self.data_reupload)
 
+            if not self.noisy(bf, pf, ad, pd, dp):
+                continue
+
+            # all noise channels are applied at once as a single channel
+            kraus = self.kraus(bf, pf, ad, pd, dp)
             for q in range(self.n_qubits):
-                qml.BitFlip(bf, wires=q)
-                qml.PhaseFlip(pf, wires=q)
-                qml.AmplitudeDamping(ad, wires=q)
-                qml.PhaseDamping(pd, wires=q)
-                qml.DepolarizingChannel(dp, wires=q)
+                qml.QubitChannel(kraus, wires=q)
 
         if self.data_reupload:
             self.pqc(w[-1], self.n_qubits)
@@ -146,8 +204,95 @@ class Model:
         else:
             return qml.expval(qml.PauliZ(wires=0))
 
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def kraus(
+        bf: float = 0.0,
+        pf: float = 0.0,
+        ad: float = 0.0,
+        pd: float = 0.0,
+        dp: float = 0.0,
+    ) -> Tuple[np.ndarray, ...]:
+        """
+        Calculates the Kraus matrices of the single qubit channel that applies
+        Bit Flip, Phase Flip, Amplitude Damping, Phase Damping and
+        Depolarization (in this order) at once.
+
+        The composition is reduced to at most four Kraus matrices using
+        the eigendecomposition of its Choi matrix.
+
+        Args:
+            bf (float, optional): Bit Flip. Defaults to 0.0.
+            pf (float, optional): Phase Flip. Defaults to 0.0.
+            ad (float, optional): Amplitude Damping. Defaults to 0.0.
+            pd (float, optional): Phase Damping. Defaults to 0.0.
+            dp (float, optional): Depolarization. Defaults to 0.0.
+
+        Returns:
+            Tuple[np.ndarray, ...]: Kraus matrices of shape (2, 2).
+        """
+        kraus = [np.eye(2, dtype=complex)]
+        for channel, p in (
+            (qml.BitFlip, bf),
+            (qml.PhaseFlip, pf),
+            (qml.AmplitudeDamping, ad),
+            (qml.PhaseDamping, pd),
+            (qml.DepolarizingChannel, dp),
+        ):
+            # channels with a probability of zero are identities
+            if p:
+                kraus = [
+                    k_c @ k for k_c in channel.compute_kraus_matrices(p) for k in kraus
+                ]
+
+        # Choi matrix of the composed channel, i.e. sum_i vec(K_i) vec(K_i)^H
+        vecs = np.array([k.reshape(-1) for k in kraus])
+        eigvals, eigvecs = np.linalg.eigh(vecs.T @ vecs.conj())
+
+        return tuple(
+            np.sqrt(eigval) * eigvec.reshape(2, 2)
+            for eigval, eigvec in zip(eigvals, eigvecs.T)
+            if eigval > 1e-12
+        )
+
+    @staticmethod
+    def noisy(
+        bf: float = 0.0,
+        pf: float = 0.0,
+        ad: float = 0.0,
+        pd: float = 0.0,
+        dp: float = 0.0,
+    ) -> bool:
+        """
+        Checks if any of the noise probabilities is non-zero.
+
+        Args:
+            bf (float, optional): Bit Flip. Defaults to 0.0.
+            pf (float, optional): Phase Flip. Defaults to 0.0.
+            ad (float, optional): Amplitude Damping. Defaults to 0.0.
+            pd (float, optional): Phase Damping. Defaults to 0.0.
+            dp (float, optional): Depolarization. Defaults to 0.0.
+
+        Returns:
+            bool: True if the circuit has to be simulated with noise.
+        """
+        return any(p != 0.0 for p in (bf, pf, ad, pd, dp))
+
     def __call__(self, *args: Any, **kwds: Any) -> Any:
-        return self.circuit(*args, **kwds)
+        noise = {k: kwds[k] for k in ("bf", "pf", "ad", "pd", "dp") if k in kwds}
+        if self.noisy(**noise):
+            return self.circuit(*args, **kwds)
+
+        # lightning.qubit expands broadcasted inputs into one execution per
+        # entry, whereas default.qubit handles them natively and is faster then
+        w, x = args[:2]
+        if (
+            self.circuit_lightning is not None
+            and qml.math.ndim(w) == len(self.n_params)
+            and qml.math.ndim(x) == 0
+        ):
+            return self.circuit_lightning(*args, **kwds)
+        return self.circuit_pure(*args, **kwds)
 
 
 class Instructor:
@@ -185,20 +330,19 @@ class Instructor:
 
         rng = np.random.default_rng(seed)
 
-        x_domain = [-1 * np.pi, 1 * np.pi]  # [-4 * np.pi, 4 * np.pi]
-        omega_d = np.array([1, 2, 3])
-
-        n_d = int(np.ceil(2 * np.max(np.abs(x_domain)) * np.max(omega_d)))
-        self.x_d = np.linspace(x_domain[0], x_domain[1], n_d)
-
-        y_fct = lambda x: 1 / np.linalg.norm(omega_d) * np.sum(np.cos(omega_d * x))
-        self.y_d = np.array([y_fct(x) for x in self.x_d])
+        # the target does not depend on the configuration,
+        # so all instructors share the same data
+        self.x_d = _X_D
+        self.y_d = _Y_D
 
         # self.weights = 2 * np.pi * rng.random(size=(impl_n_layers, n_qubits * 3))
         self.weights = 2 * np.pi * rng.random(size=self.model.n_params)
 
         self.opt = qml.AdamOptimizer(stepsize=0.01)
 
+        # trainable buffer that is reused for the weights in each step
+        self._w = pnp.zeros(self.model.n_params, requires_grad=True)
+
     def calc_hist(
         self,
         w: np.ndarray,
@@ -224,29 +368,21 @@ class Instructor:
             the real and imaginary part of the coefficients respectively, and "comb"
             containing the combination of the two.
         """
-        coeffs = coefficients(
-            partial(self.forward, weights=w, bf=bf, pf=pf, ad=ad, pd=pd, dp=dp),
-            1,
-            self.max_freq,
-        )
-        nvecs_formatted, data = _extract_data_and_labels(np.array([coeffs]))
-        data_len = len(data["real"][0])
-        """Calculate the histogram of the coefficients of the circuit output.
-
-        Args:
-            w (np.ndarray): The weights of the quantum circuit.
-            bf (float): The bit flip rate.
-            pf (float): The phase flip rate.
-            ad (float): The amplitude damping rate.
-            pd (float): The phase damping rate.
-            dp (float): The depolarization rate.
+        # sample the 2*max_freq+1 points x_k = 2*pi*k/N of the Fourier grid
+        # in a single broadcasted call, the coefficients are then given by
+        # the DFT of the samples
+        data_len = 2 * self.max_freq + 1
+        x = 2 * np.pi * np.arange(data_len) / data_len
+        y = self.forward(x, weights=w, bf=bf, pf=pf, ad=ad, pd=pd, dp=dp)
+        # without layers, x is never encoded and the output is not broadcasted
+        y = np.broadcast_to(y, x.shape)
+        # the expectation value is real, so the rfft yields the coefficients
+        # of all frequencies 0..max_freq and the negative frequencies are
+        # their complex conjugates
+        coeffs = np.fft.rfft(y) / data_len
+        coeffs = np.concatenate([np.conj(coeffs[:0:-1]), coeffs])
+        data = {"real": np.real(coeffs)[None, :], "imag": np.imag(coeffs)[None, :]}
 
-        Returns:
-            A tuple of (int, Dict[str, np.ndarray]): The length of the histogram and a
-            dictionary with the histogram data. The dictionary has the keys "real" and
-            "imag" containing the real and imaginary part of the coefficients
-            respectively, and "comb" containing the combination of the two.
-        """
         data["comb"] = np.sqrt(data["real"] ** 2 + data["imag"] ** 2)
 
         return data_len, data
@@ -356,7 +492,7 @@ class Instructor:
         """
         y_pred = self.forward(self.x_d, weights=w, bf=bf, pf=pf, ad=ad, pd=pd, dp=dp)
 
-        return np.mean((y_d - y_pred) ** 2)
+        return pnp.mean((y_d - y_pred) ** 2)
 
     def step(
         self,
@@ -381,12 +517,71 @@ class Instructor:
             Tuple[np.ndarray, float]: The updated weights and the cost of the model.
         """
         if len(w) == 0:
+            # a new training run starts, so drop the optimizer state
+            # that might be left over from a previous run. This only matters
+            # for in-process use, the app runs each step in a forked
+            # background job that discards the optimizer state anyway
             w = self.weights
+            self.opt = qml.AdamOptimizer(stepsize=0.01)
 
-        w = np.array(w, requires_grad=True)
+        np.copyto(self._w, w)
+        w = self._w
 
         w, cost = self.opt.step_and_cost(
             self.cost, w, y_d=self.y_d, bf=bf, pf=pf, ad=ad, pd=pd, dp=dp
         )
 
         return w, cost
+
+
+def get_instructor(
+    n_qubits: int,
+    n_layers: int,
+    seed: int = 100,
+    circuit_type: int = 19,
+    data_reupload: bool = True,
+) -> Instructor:
+    """Returns a cached Instructor for the given configuration.
+
+    Building an Instructor creates a new device and QNode, which is costly
+    compared to the actual simulation for small circuits. Callbacks that
+    share the same configuration therefore share the same instance.
+    The devices keep their state on the device object, so instances are
+    only shared within the same thread.
+
+    Args:
+        n_qubits: Number of qubits to use in the instructor circuit.
+        n_layers: Number of layers in the instructor circuit.
+        seed: Random seed to use for weight initialization.
+        circuit_type: Type of circuit to use as the instructor.
+        data_reupload: Whether or not to reupload data in the circuit.
+
+    Returns:
+        Instructor: The (possibly cached) instructor.
+    """
+    return _get_instructor(
+        threading.get_ident(),
+        n_qubits,
+        n_layers,
+        seed,
+        circuit_type,
+        data_reupload,
+    )
+
+
+@lru_cache(maxsize=32)
+def _get_instructor(
+    thread_id: int,
+    n_qubits: int,
+    n_layers: int,
+    seed: int,
+    circuit_type: int,
+    data_reupload: bool,
+) -> Instructor:
+    return Instructor(
+        n_qubits,
+        n_layers,
+        seed=seed,
+        circuit_type=circuit_type,
+        data_reupload=data_reupload,
+    )